@@ -0,0 +1,347 @@
+import os
+import sys
+import argparse
+import contextlib
+import html
+import multiprocessing
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+from main import (WEBSITES_FILE, DEFAULT_CONCURRENCY, ScrapeOptions, load_websites, create_session, fetch_page,
+                  extract_metadata, available_parsers, process_urls, aiohttp)
+
+CORPUS_FOLDER = os.path.join(".cache", "corpus")
+DEFAULT_LATENCY_MS = 50
+DEFAULT_COPIES = 10
+DEFAULT_HOSTS = 4
+
+# Synthetic pages are built from blocks of about BLOCK_SIZE bytes, each a paragraph plus its share of links and images
+SYNTHETIC_BLOCK_SIZE = 1024
+DEFAULT_SYNTHETIC_SIZES_KB = (10, 50, 250, 1000, 5000)
+RUSSIAN_WORDS = (
+    "суд", "право", "закон", "договор", "компания", "клиент", "арбитраж", "санкции", "налог", "юрист",
+    "практика", "решение", "защита", "интересы", "бизнес", "споры", "банкротство", "консультация", "это", "для",
+    "и", "в", "на", "по", "с", "как", "что", "мы", "они", "их",
+)
+ENGLISH_WORDS = (
+    "court", "law", "contract", "company", "client", "arbitration", "sanctions", "tax", "lawyer", "practice",
+    "decision", "defense", "interests", "business", "disputes", "bankruptcy", "advice", "this", "for", "and",
+    "in", "on", "by", "with", "as", "what", "we", "they", "their", "the",
+)
+META_SETS = {
+    "none": [],
+    "basic": [("name", "description"), ("name", "keywords"), ("name", "author")],
+    "social": [("name", "description"), ("name", "keywords"), ("name", "author"), ("property", "og:title"),
+               ("property", "og:description"), ("property", "og:image"), ("property", "og:type"),
+               ("name", "twitter:card"), ("name", "twitter:title"), ("property", "article:published_time")],
+}
+
+def load_pages(pages_dir):
+    """Loads saved .html pages from a folder as (name, content) pairs."""
+    pages = []
+    for name in sorted(os.listdir(pages_dir)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(pages_dir, name), "rb") as f:
+                pages.append((name, f.read()))
+    return pages
+
+def download_pages(urls):
+    """Downloads each URL once so parsing can be timed without the network."""
+    pages = []
+    with create_session() as session:
+        for url in urls:
+            page = fetch_page(url, session)
+            if page is not None:
+                pages.append((url, page[0]))
+    return pages
+
+def record_pages(pages, folder):
+    """Saves downloaded (url, content) pairs as .html files, so later benchmarks need no network."""
+    os.makedirs(folder, exist_ok=True)
+    for url, content in pages:
+        name = url.replace("http://", "").replace("https://", "").replace("/", "_")
+        with open(os.path.join(folder, f"{name}.html"), "wb") as f:
+            f.write(content)
+    print(f"Recorded {len(pages)} pages to {folder}")
+
+def generate_page(size, seed=0, russian=0.5, links_per_kb=4.0, images_per_kb=2.0, meta="social", external=0.5):
+    """Generates a reproducible HTML page of about size bytes.
+
+    russian is the share of Russian words, links_per_kb and images_per_kb set the tag density, meta picks one of
+    META_SETS and external is the share of links pointing to other sites.
+    """
+    rng = random.Random(seed)
+
+    def words(count):
+        return " ".join(rng.choice(RUSSIAN_WORDS if rng.random() < russian else ENGLISH_WORDS) for _ in range(count))
+
+    def scaled(per_kb):
+        # Rounds up or down at random so fractional densities average out over the page
+        expected = per_kb * SYNTHETIC_BLOCK_SIZE / 1024
+        return int(expected) + (rng.random() < expected % 1)
+
+    head = [f"<title>{html.escape(words(6))}</title>", '<meta charset="utf-8">']
+    head += [f'<meta {key}="{value}" content="{html.escape(words(12))}">' for key, value in META_SETS[meta]]
+    head.append('<link rel="canonical" href="https://synthetic.example/">')
+    parts = ["<!DOCTYPE html>\n<html><head>", *head, "</head><body>"]
+    written = sum(len(part.encode()) for part in parts)
+    block = 0
+    while written < size:
+        tags = []
+        for link in range(scaled(links_per_kb)):
+            href = (f"https://site{rng.randrange(1000)}.example/{block}/{link}" if rng.random() < external
+                    else f"/page/{block}/{link}")
+            tags.append(f'<a href="{href}">{words(2)}</a>')
+        tags += [f'<img src="/images/{block}/{image}.jpg" alt="">' for image in range(scaled(images_per_kb))]
+        # Pad the block with paragraph text up to BLOCK_SIZE, so the densities hold per KB of output
+        text = words(1)
+        while len(text.encode()) + sum(len(tag.encode()) + 1 for tag in tags) + len("<p></p>") < SYNTHETIC_BLOCK_SIZE:
+            text += " " + words(1)
+        chunk = "\n".join([f"<p>{text}</p>", *tags])
+        parts.append(chunk)
+        written += len(chunk.encode())
+        block += 1
+    parts.append("</body></html>")
+    return "\n".join(parts).encode()
+
+def write_synthetic_pages(folder, sizes_kb, **page_options):
+    """Writes one generated page per size to a folder, for use with --pages."""
+    os.makedirs(folder, exist_ok=True)
+    for size_kb in sizes_kb:
+        with open(os.path.join(folder, f"synthetic_{size_kb}kb.html"), "wb") as f:
+            f.write(generate_page(size_kb * 1024, **page_options))
+    print(f"Wrote {len(sizes_kb)} synthetic pages to {folder}")
+
+def time_parse(url, content, backend, repeats):
+    """Returns the median time in milliseconds to extract metadata with a backend."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        extract_metadata(url, content, backend)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def benchmark_parsers(pages, repeats):
+    """Prints per-page parse times for every installed backend and checks their results match."""
+    backends = available_parsers()
+    width = max(len(name) for name, _ in pages)
+    print(f"{'Page':<{width}} | {'KB':>6} | " + " | ".join(f"{backend:>11}" for backend in backends))
+    totals = dict.fromkeys(backends, 0.0)
+    for name, content in pages:
+        url = name if urlparse(name).scheme else f"https://{name}"
+        reference = extract_metadata(url, content, backends[0])
+        cells = []
+        for backend in backends:
+            elapsed = time_parse(url, content, backend, repeats)
+            totals[backend] += elapsed
+            mismatch = "" if extract_metadata(url, content, backend) == reference else "*"
+            cells.append(f"{elapsed:>9.2f}ms{mismatch or ' '}")
+        print(f"{name:<{width}} | {len(content) / 1024:>6.0f} | " + " | ".join(cells))
+    print(f"{'Total':<{width}} | {'':>6} | " + " | ".join(f"{totals[backend]:>9.2f}ms " for backend in backends))
+    print(f"* metadata differs from the {backends[0]} result")
+
+def measure_parse(url, content, backend, repeats):
+    """Returns the median parse time in milliseconds and the peak RSS growth in MB while parsing.
+
+    Meant to run in a fresh process, whose peak RSS before parsing is that of the page alone.
+    """
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = time_parse(url, content, backend, repeats)
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / scale
+
+def benchmark_sizes(sizes_kb, repeats, plot_file=None, **page_options):
+    """Times every installed backend on generated pages of growing size, printing parse time and memory per size."""
+    backends = available_parsers()
+    results = {backend: [] for backend in backends}
+    print(f"{'Size':>7} | " + " | ".join(f"{backend:>20}" for backend in backends))
+    context = multiprocessing.get_context("spawn")
+    for size_kb in sizes_kb:
+        content = generate_page(size_kb * 1024, **page_options)
+        cells = []
+        for backend in backends:
+            # One process per measurement, so each peak RSS starts from a clean interpreter
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                elapsed, memory = executor.submit(
+                    measure_parse, "https://synthetic.example/", content, backend, repeats
+                ).result()
+            results[backend].append((elapsed, memory))
+            cells.append(f"{elapsed:>9.1f}ms {memory:>6.1f} MB")
+        print(f"{size_kb:>5}KB | " + " | ".join(cells))
+    if plot_file:
+        plot_sizes(sizes_kb, results, plot_file)
+
+def plot_sizes(sizes_kb, results, plot_file):
+    """Saves parse time and memory against page size for every backend as an image."""
+    if plt is None:
+        print("Skipping the plot: matplotlib is not installed")
+        return
+    figure, (time_axis, memory_axis) = plt.subplots(1, 2, figsize=(12, 5))
+    for backend, points in results.items():
+        time_axis.plot(sizes_kb, [elapsed for elapsed, _ in points], marker="o", label=backend)
+        memory_axis.plot(sizes_kb, [memory for _, memory in points], marker="o", label=backend)
+    for axis, label in ((time_axis, "Parse time (ms)"), (memory_axis, "Peak RSS growth (MB)")):
+        axis.set(xscale="log", yscale="log", xlabel="Page size (KB)", ylabel=label)
+        axis.legend()
+    figure.tight_layout()
+    figure.savefig(plot_file)
+    print(f"Plot saved to {plot_file}")
+
+def serve_corpus(pages, latency, hosts):
+    """Serves the pages as /<index>.html from one local server per simulated host, each response delayed by latency seconds."""
+    bodies = [content for _, content in pages]
+
+    class CorpusHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            try:
+                body = bodies[int(urlparse(self.path).path.strip("/").removesuffix(".html"))]
+            except (ValueError, IndexError):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    servers = []
+    for _ in range(hosts):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), CorpusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def corpus_urls(servers, page_count, copies):
+    """Lists every page copies times, spreading the copies over the servers so each host gets its share."""
+    return [
+        f"http://127.0.0.1:{servers[(copy * page_count + index) % len(servers)].server_port}/{index}.html?copy={copy}"
+        for copy in range(copies) for index in range(page_count)
+    ]
+
+def cpu_seconds():
+    """Returns the CPU time used so far by this process and its finished children, such as parse pool workers."""
+    own, workers = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + workers.ru_utime + workers.ru_stime
+
+def run_crawl(urls, options):
+    """Runs process_urls into a temporary folder, returning its wall time, CPU time and peak RSS in MB.
+
+    CPU time is counted from just before process_urls, leaving out interpreter start-up and imports.
+    """
+    with tempfile.TemporaryDirectory() as folder, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cpu_start, start = cpu_seconds(), time.perf_counter()
+        process_urls(urls, folder, os.path.join(folder, "benchmark.csv"), options)
+        elapsed, cpu = time.perf_counter() - start, cpu_seconds() - cpu_start
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = own.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return elapsed, cpu, peak_rss
+
+def crawl_modes():
+    """Returns the fetch modes to compare, by name."""
+    modes = {
+        "sequential": ScrapeOptions(concurrency=1),
+        "threads": ScrapeOptions(workers=DEFAULT_CONCURRENCY),
+    }
+    if aiohttp is not None:
+        modes["async"] = ScrapeOptions()
+        modes["async + parse pool"] = ScrapeOptions(parse_workers=os.cpu_count())
+    return modes
+
+def benchmark_crawl(pages, latency_ms, copies, hosts):
+    """Crawls the pages from local servers in every fetch mode, printing throughput, CPU time per page and peak RSS."""
+    servers = serve_corpus(pages, latency_ms / 1000, hosts)
+    urls = corpus_urls(servers, len(pages), copies)
+    print(f"{len(urls)} URLs on {hosts} local hosts, {latency_ms} ms latency per response")
+    print(f"{'Mode':<20} | {'URLs/s':>8} | {'CPU/page':>10} | {'Peak RSS':>9}")
+    try:
+        for name, options in crawl_modes().items():
+            # A fresh process per mode, so peak RSS and CPU time are not carried over from the previous mode
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                elapsed, cpu, peak_rss = executor.submit(run_crawl, urls, options).result()
+            print(f"{name:<20} | {len(urls) / elapsed:>8.1f} | {cpu / len(urls) * 1000:>8.2f}ms | {peak_rss:>6.0f} MB")
+    finally:
+        for server in servers:
+            server.shutdown()
+
+def parse_args():
+    """Parses command-line options."""
+    parser = argparse.ArgumentParser(description="Benchmarks the HTML parser backends and fetch modes used by main.py.")
+    parser.add_argument("--pages",
+                        help=f"folder of saved .html pages (default: the partisans pages recorded in {CORPUS_FOLDER})")
+    parser.add_argument("--record", action="store_true",
+                        help=f"download the partisans URLs again and overwrite the pages recorded in {CORPUS_FOLDER}")
+    parser.add_argument("--repeats", type=int, default=5, help="parses per page and backend (default: 5)")
+    parser.add_argument("--crawl", action="store_true",
+                        help="benchmark process_urls in every fetch mode against local servers instead of the parsers")
+    parser.add_argument("--latency", type=int, default=DEFAULT_LATENCY_MS,
+                        help=f"milliseconds the local servers wait before each response (default: {DEFAULT_LATENCY_MS})")
+    parser.add_argument("--copies", type=int, default=DEFAULT_COPIES,
+                        help=f"times each page is crawled, under a different URL (default: {DEFAULT_COPIES})")
+    parser.add_argument("--hosts", type=int, default=DEFAULT_HOSTS,
+                        help=f"local servers the pages are spread over (default: {DEFAULT_HOSTS})")
+    synthetic = parser.add_argument_group("synthetic pages")
+    synthetic.add_argument("--synthetic", action="store_true",
+                           help="time parsing and memory on generated pages of growing size instead of real pages")
+    synthetic.add_argument("--generate", metavar="FOLDER",
+                           help="write the generated pages to a folder, e.g. for --crawl --pages FOLDER, and exit")
+    synthetic.add_argument("--sizes", default=",".join(map(str, DEFAULT_SYNTHETIC_SIZES_KB)),
+                           help="comma-separated page sizes in KB (default: %(default)s)")
+    synthetic.add_argument("--russian", type=float, default=0.5, help="share of Russian words (default: 0.5)")
+    synthetic.add_argument("--links-per-kb", type=float, default=4.0, help="links per KB of page (default: 4)")
+    synthetic.add_argument("--images-per-kb", type=float, default=2.0, help="images per KB of page (default: 2)")
+    synthetic.add_argument("--external", type=float, default=0.5, help="share of external links (default: 0.5)")
+    synthetic.add_argument("--meta", choices=list(META_SETS), default="social", help="meta tags in the head (default: social)")
+    synthetic.add_argument("--seed", type=int, default=0, help="random seed, the same seed gives the same pages (default: 0)")
+    synthetic.add_argument("--plot", metavar="FILE", help="save parse time and memory against size as an image (requires matplotlib)")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    page_options = dict(seed=args.seed, russian=args.russian, links_per_kb=args.links_per_kb,
+                        images_per_kb=args.images_per_kb, meta=args.meta, external=args.external)
+    if args.generate:
+        write_synthetic_pages(args.generate, args.sizes, **page_options)
+        sys.exit()
+    if args.synthetic:
+        benchmark_sizes(args.sizes, args.repeats, args.plot, **page_options)
+        sys.exit()
+
+    if args.pages:
+        pages = load_pages(args.pages)
+    elif os.path.isdir(CORPUS_FOLDER) and not args.record:
+        pages = load_pages(CORPUS_FOLDER)
+    else:
+        websites, partisans_urls = load_websites(WEBSITES_FILE)
+        pages = download_pages(partisans_urls)
+        if pages:
+            record_pages(pages, CORPUS_FOLDER)
+
+    if not pages:
+        print("No pages to benchmark.")
+    elif args.crawl:
+        benchmark_crawl(pages, args.latency, args.copies, args.hosts)
+    else:
+        benchmark_parsers(pages, args.repeats)
@@ -1,17 +1,116 @@
 import os
 import json
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError, ReadTimeoutError, ProtocolError, DecodeError
+from requests.structures import CaseInsensitiveDict
+from bs4 import BeautifulSoup, UnicodeDammit
 import unicodedata
-from datetime import datetime
-from collections import Counter
+import hashlib
+import heapq
+import random
+import email.utils
+import gzip
+import uuid
+import zlib
+import math
+import time
+from datetime import datetime, timezone
+from collections import Counter, namedtuple
 from urllib.parse import urlparse
 import re
 import csv
+import sys
+import argparse
+import asyncio
+import contextlib
+import itertools
+import queue
+import socket
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 OUTPUT_FOLDER = "output"
 PARTISANS_FOLDER = os.path.join(OUTPUT_FOLDER, "partisans")
 WEBSITES_FILE = "websites.json"
+CACHE_FILE = os.path.join(".cache", "responses.sqlite3")
+# Bump when extract_metadata changes, so cached extractions are not reused for new logic
+EXTRACTION_VERSION = 1
+LATENCY_FILE = os.path.join(".cache", "latency.json")
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_TOTAL_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+DNS_PREFETCH_WORKERS = 32
+# Adaptive timeouts allow each host this many times its p99 latency from earlier runs, within these bounds
+ADAPTIVE_TIMEOUT_FACTOR = 4
+ADAPTIVE_MIN_TIMEOUT = 2
+ADAPTIVE_MAX_TIMEOUT = 60
+DEFAULT_CONCURRENCY = 20
+DEFAULT_PER_HOST = 4
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BURST = 1
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+RETRY_MAX_DELAY = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+# Cool-downs a URL waits out while its host's circuit is open, before it fails without being sent
+BREAKER_MAX_WAITS = 3
+# Fetches start at most this many URLs past the first unfinished one, bounding the results held back for input order
+FETCH_WINDOW = 1000
+POOLED_HOSTS = 100
+DEFAULT_PARSER = "html.parser"
+CHUNK_SIZE = 16 * 1024
+HEAD_ONLY_MAX_BYTES = 256 * 1024
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+CSV_FLUSH_EVERY = 100
+PARQUET_ROW_GROUP_SIZE = 1000
+HISTORY_COMMIT_EVERY = 100
+HEAD_END = b"</head>"
+# Stage timing histograms: bucket upper bounds start at TIMING_MIN_SECONDS and grow by 10% per bucket
+TIMING_MIN_SECONDS = 0.0001
+TIMING_BUCKET_GROWTH = 1.1
+TIMING_PERCENTILES = (50, 95, 99)
+TIMING_REPORT_HOSTS = 5
+METRICS_HOST = "127.0.0.1"
+# Upper bounds of the exported latency histogram buckets, the Prometheus client defaults
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Elements whose attributes are collected by the parser backends, and elements whose text is not visible
+COLLECTED_TAGS = ("meta", "link", "img", "a")
+TEXTLESS_TAGS = ("script", "style", "template")
+SOCIAL_PREFIXES = ("og:", "twitter:", "article:")
+
+PageTree = namedtuple("PageTree", ["title", "tags", "strings"])
+
+save_lock = threading.Lock()
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 os.makedirs(PARTISANS_FOLDER, exist_ok=True)
@@ -26,72 +125,1303 @@ def load_websites(file_path):
         print(f"Error loading {file_path}: {e}")
         return [], []
 
-def fetch_metadata(url):
-    """Fetches metadata and performs additional analysis."""
-    no_data = "— — —"
+def load_rate_limits(file_path):
+    """Loads per-domain rate limit overrides, e.g. {"pgplaw.ru": {"rate": 0.5, "burst": 1}}, from the JSON file."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        # Metadata
-        metadata = {
-            "url": url,
-            "title": (soup.title.string.strip() if soup.title else no_data),
-            "description": (soup.find("meta", attrs={"name": "description"}) or {}).get("content", no_data).strip(),
-            "keywords": (soup.find("meta", attrs={"name": "keywords"}) or {}).get("content", no_data).strip(),
-            "author": (soup.find("meta", attrs={"name": "author"}) or {}).get("content", no_data).strip(),
+        with open(file_path, encoding="utf-8") as f:
+            return json.load(f).get("rate_limits", {})
+    except (FileNotFoundError, json.JSONDecodeError):
+        # load_websites already reports a missing or invalid file
+        return {}
+
+@dataclass
+class ScrapeOptions:
+    """Settings for a process_urls run, shared by its fetch and parse stages."""
+    concurrency: int = DEFAULT_CONCURRENCY
+    per_host: int = DEFAULT_PER_HOST
+    pool_size: int = DEFAULT_POOL_SIZE
+    workers: int | None = None
+    parse_workers: int | None = None
+    backend: str = DEFAULT_PARSER
+    head_only: bool = False
+    max_bytes: int = DEFAULT_MAX_BYTES
+    cache_file: str | None = None
+    resume: bool = False
+    parquet: bool = False
+    history_db: str | None = None
+    jsonl: str | None = None
+    timings_json: bool = False
+    warc: str | None = None
+    replay: str | None = None
+    rate: float | None = None
+    burst: int = DEFAULT_BURST
+    rate_limits: dict = field(default_factory=dict)
+    retries: int = DEFAULT_RETRIES
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF
+    breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD
+    breaker_cooldown: float = DEFAULT_BREAKER_COOLDOWN
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT
+    read_timeout: float = DEFAULT_READ_TIMEOUT
+    total_timeout: float = DEFAULT_TOTAL_TIMEOUT
+    adaptive_timeouts: bool = False
+    latency_file: str | None = None
+    dns_ttl: float = DNS_CACHE_TTL
+
+class BodyReader:
+    """Accumulates a streamed response body, stopping once max_bytes is exceeded.
+
+    In head-only mode it also stops after </head>, and never reads more than HEAD_ONLY_MAX_BYTES.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, head_only=False):
+        self.head_only = head_only
+        self.limit = min(max_bytes, HEAD_ONLY_MAX_BYTES) if head_only else max_bytes
+        self.body = bytearray()
+        self.truncated = False
+        self.complete = True
+
+    def feed(self, chunk):
+        """Adds a chunk, returning True once the rest of the response is not needed."""
+        self.body += chunk
+        if self.head_only:
+            # Only the new chunk (plus a tag-sized overlap) can contain a </head> not seen before
+            start = max(0, len(self.body) - len(chunk) - len(HEAD_END) + 1)
+            end = self.body[start:].lower().find(HEAD_END)
+            if end != -1:
+                del self.body[start + end + len(HEAD_END):]
+                self.complete = False
+                return True
+        if len(self.body) > self.limit:
+            del self.body[self.limit:]
+            self.truncated = True
+            self.complete = False
+            return True
+        return False
+
+class ResponseCache:
+    """SQLite store of response bodies with their ETag / Last-Modified validators, and of the metadata extracted from them."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, body BLOB, fetched_at TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS extractions "
+            "(url TEXT, head_only INTEGER, digest TEXT, metadata TEXT, saved_to TEXT, PRIMARY KEY (url, head_only))"
+        )
+        # Caches from before saved_to was recorded
+        if "saved_to" not in {row[1] for row in self.db.execute("PRAGMA table_info(extractions)")}:
+            self.db.execute("ALTER TABLE extractions ADD COLUMN saved_to TEXT")
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def validators(self, url):
+        """Returns the conditional request headers for a cached URL, or an empty dict."""
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return {}
+        etag, last_modified = row
+        headers = {"If-None-Match": etag, "If-Modified-Since": last_modified}
+        return {key: value for key, value in headers.items() if value}
+
+    def store(self, url, body, headers):
+        """Caches a complete response if the server sent a validator for it."""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, json.dumps(dict(headers)), body, datetime.now().isoformat()),
+            )
+            self.db.commit()
+
+    def revalidated(self, url, headers):
+        """Returns the cached body and headers after a 304, refreshing the stored headers from it."""
+        with self.lock:
+            stored_headers, body = self.db.execute(
+                "SELECT headers, body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            merged = CaseInsensitiveDict(json.loads(stored_headers))
+            merged.update((key, value) for key, value in headers.items() if key.lower() != "content-length")
+            self.db.execute(
+                "UPDATE responses SET etag = ?, last_modified = ?, headers = ?, fetched_at = ? WHERE url = ?",
+                (merged.get("ETag"), merged.get("Last-Modified"), json.dumps(dict(merged)),
+                 datetime.now().isoformat(), url),
+            )
+            self.db.commit()
+            self.hits += 1
+        return body, merged
+
+    def extracted(self, url, digest, head_only):
+        """Returns the metadata previously extracted from a body with this digest and the .md file it was saved to,
+        or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT metadata, saved_to FROM extractions WHERE url = ? AND head_only = ? AND digest = ?",
+                (url, head_only, digest),
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def store_extracted(self, url, digest, head_only, metadata, saved_to):
+        """Remembers the metadata extracted from a body with this digest, once it is saved to an .md file."""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?)",
+                (url, head_only, digest, json.dumps(metadata, ensure_ascii=False), saved_to),
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class WarcWriter:
+    """Appends each fetched response to a WARC file, gzipping every record separately for a .warc.gz path.
+
+    Bodies are stored as they were processed: decoded, possibly truncated, and taken from the cache after a 304.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.compress = path.endswith(".gz")
+        self.file = open(path, "ab")
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def write(self, url, content, headers):
+        # The body is already decoded and may be cut short, so its length replaces the transfer headers
+        http_headers = "".join(
+            f"{key}: {value}\r\n" for key, value in headers.items()
+            if key.lower() not in ("content-encoding", "transfer-encoding", "content-length")
+        )
+        block = f"HTTP/1.1 200 OK\r\n{http_headers}Content-Length: {len(content)}\r\n\r\n".encode(
+            "utf-8", "surrogateescape") + content
+        record = (
+            f"WARC/1.1\r\nWARC-Type: response\r\nWARC-Record-ID: <urn:uuid:{uuid.uuid4()}>\r\n"
+            f"WARC-Date: {datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}\r\nWARC-Target-URI: {url}\r\n"
+            f"Content-Type: application/http;msgtype=response\r\nContent-Length: {len(block)}\r\n\r\n"
+        ).encode() + block + b"\r\n\r\n"
+        with self.lock:
+            self.file.write(gzip.compress(record) if self.compress else record)
+            self.records += 1
+
+    def close(self):
+        self.file.close()
+        if self.records:
+            print(f"Archived {self.records} responses to {self.path}")
+
+class WarcArchive:
+    """Reads responses back from a WARC file, indexed by target URI so only the requested records are decoded.
+
+    A .warc.gz file must be gzipped per record, as WarcWriter and most crawlers do. When a URL was archived more
+    than once, the latest record wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith(".gz")
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+        self.offsets = {}
+        offset = 0
+        while (record := self.read_record(offset)) is not None:
+            warc_headers, block, next_offset = record
+            if warc_headers.get("WARC-Type") == "response" and "WARC-Target-URI" in warc_headers:
+                self.offsets[warc_headers["WARC-Target-URI"].strip("<>")] = offset
+            offset = next_offset
+        print(f"Replaying {len(self.offsets)} responses from {path}")
+
+    def read_record(self, offset):
+        """Returns the WARC headers, content block and next record offset at offset, or None at the end of the file."""
+        self.file.seek(offset)
+        if self.compressed:
+            decompressor, parts = zlib.decompressobj(zlib.MAX_WBITS | 16), []
+            while not decompressor.eof:
+                chunk = self.file.read(CHUNK_SIZE)
+                if not chunk:
+                    return None
+                parts.append(decompressor.decompress(chunk))
+            next_offset = self.file.tell() - len(decompressor.unused_data)
+            data = b"".join(parts)
+            header_end = data.find(b"\r\n\r\n")
+            header, rest = data[:header_end], data[header_end + 4:]
+        else:
+            lines = []
+            while (line := self.file.readline()) not in (b"\r\n", b""):
+                lines.append(line)
+            if not lines:
+                return None
+            header, rest = b"".join(lines), None
+        fields = header.decode("utf-8", "replace").split("\r\n")[1:]
+        warc_headers = CaseInsensitiveDict(
+            (key.strip(), value.strip()) for key, value in (field.split(":", 1) for field in fields if ":" in field)
+        )
+        length = int(warc_headers.get("Content-Length", 0))
+        if rest is None:
+            rest = self.file.read(length)
+            next_offset = self.file.tell() + 4
+        return warc_headers, rest[:length], next_offset
+
+    def read(self, url):
+        """Returns the archived body and response headers for a URL, or None when it was not archived."""
+        if url not in self.offsets:
+            print(f"Error fetching metadata for {url}: not in {self.path}")
+            return None
+        with self.lock:
+            warc_headers, block, _ = self.read_record(self.offsets[url])
+        head, _, body = block.partition(b"\r\n\r\n")
+        headers = CaseInsensitiveDict(
+            (key.strip(), value.strip()) for key, value in
+            (line.split(":", 1) for line in head.decode("utf-8", "surrogateescape").split("\r\n")[1:] if ":" in line)
+        )
+        # Records captured by other crawlers hold the body as it was sent over the wire
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            body = dechunk(body)
+        if headers.get("Content-Encoding", "").lower() in ("gzip", "deflate"):
+            try:
+                body = zlib.decompress(body, zlib.MAX_WBITS | 32)
+            except zlib.error as e:
+                print(f"Error decoding {url} from {self.path}: {e}")
+                return None
+        return body, headers
+
+    def close(self):
+        self.file.close()
+
+def dechunk(body):
+    """Joins the chunks of a body sent with Transfer-Encoding: chunked."""
+    chunks, position = [], 0
+    while (line_end := body.find(b"\r\n", position)) != -1:
+        size = int(body[position:line_end].split(b";")[0] or b"0", 16)
+        if size == 0:
+            break
+        chunks.append(body[line_end + 2:line_end + 2 + size])
+        position = line_end + 2 + size + 2
+    return b"".join(chunks)
+
+class RetryableError(Exception):
+    """A transient fetch failure, raised instead of giving up while retries remain."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitOpenError(RetryableError):
+    """Raised instead of sending a request while its host's circuit is open, with retry_after until it half-opens."""
+
+def parse_retry_after(value):
+    """Returns the seconds a Retry-After header asks to wait, given as seconds or as an HTTP date."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class DnsCache:
+    """Memoizes getaddrinfo results per host and port for ttl seconds, shared by the fetch engines.
+
+    The system resolver does not report record TTLs, so every entry lives for the same ttl.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, host, port):
+        """Returns the cached addresses for a host, or None when they are missing or expired."""
+        with self.lock:
+            addresses, expires = self.entries.get((host, port), (None, 0))
+        return addresses if expires > time.monotonic() else None
+
+    def resolve(self, host, port):
+        """Returns (family, type, proto, canonname, sockaddr) tuples for a host, resolving it only on a cache miss."""
+        addresses = self.lookup(host, port)
+        if addresses is None:
+            addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            with self.lock:
+                self.entries[(host, port)] = addresses, time.monotonic() + self.ttl
+        return addresses
+
+    def prefetch(self, urls):
+        """Resolves every unique host of the URLs concurrently, so lookups are off the critical path of the fetches."""
+        hosts = set()
+        for url in urls:
+            # Malformed URLs are left for the fetch to report
+            try:
+                parsed = urlparse(url)
+                if parsed.hostname:
+                    hosts.add((parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80)))
+            except ValueError:
+                continue
+        if not hosts:
+            return
+
+        def resolve(host_port):
+            try:
+                return bool(self.resolve(*host_port))
+            except OSError:
+                return False
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(DNS_PREFETCH_WORKERS, len(hosts))) as executor:
+            resolved = sum(executor.map(resolve, hosts))
+        print(f"Resolved {resolved} of {len(hosts)} hosts in {time.perf_counter() - start:.2f}s")
+
+class LatencyHistory:
+    """Per-host p99 latencies of the connection and download stages, kept in a JSON file between runs."""
+
+    STAGES = ("dns", "connect", "tls", "response", "download")
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.hosts = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.hosts = {}
+
+    def timeouts(self, host, connect, read, total):
+        """Returns (connect, read, total) timeouts for a host, scaled from its recorded latencies where known."""
+        latencies = self.hosts.get(host)
+        if not latencies:
+            return connect, read, total
+
+        def scaled(seconds):
+            return min(ADAPTIVE_MAX_TIMEOUT, max(ADAPTIVE_MIN_TIMEOUT, seconds * ADAPTIVE_TIMEOUT_FACTOR))
+
+        setup = [latencies[stage] for stage in ("dns", "connect", "tls") if stage in latencies]
+        if setup:
+            connect = scaled(sum(setup))
+        if "response" in latencies:
+            read = scaled(latencies["response"])
+        total = max(connect, read, scaled(sum(latencies[stage] for stage in self.STAGES if stage in latencies)))
+        return connect, read, total
+
+    def update(self, timings):
+        """Replaces the latencies of every host timed in this run.
+
+        Hosts that timed out are forgotten instead, so their next run starts from the configured timeouts rather
+        than from latencies that proved too short.
+        """
+        for host in timings.hosts():
+            summary = timings.summary(host)
+            if "timeout" in summary:
+                self.hosts.pop(host, None)
+                continue
+            latencies = {stage: summary[stage]["p99"] for stage in self.STAGES if stage in summary}
+            if latencies:
+                self.hosts[host] = dict(latencies, updated=datetime.now().strftime("%Y-%m-%d"))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        partial_file = f"{self.path}.partial"
+        try:
+            with open(partial_file, "w", encoding="utf-8") as f:
+                json.dump(self.hosts, f, indent=2)
+            os.replace(partial_file, self.path)
+        except Exception as e:
+            print(f"Error saving latencies: {e}")
+
+class CircuitBreakers:
+    """A circuit breaker per host, opened after threshold consecutive failures.
+
+    While a host's circuit is open its URLs fail fast. After cooldown seconds it half-opens: one trial request
+    goes through, and closes the circuit again if it succeeds or reopens it if it fails.
+    """
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = Counter()
+        self.opened = {}
+        self.trials = set()
+        self.trips = Counter()
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        """Returns None when a request to the host may go ahead, otherwise the seconds until it is worth trying."""
+        with self.lock:
+            if host not in self.opened:
+                return None
+            remaining = self.opened[host] + self.cooldown - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if host in self.trials:
+                return self.cooldown
+            self.trials.add(host)
+            return None
+
+    def record(self, host, failed):
+        """Records the outcome of a request to the host, opening or closing its circuit."""
+        with self.lock:
+            trial = host in self.trials
+            self.trials.discard(host)
+            if not failed:
+                self.failures.pop(host, None)
+                if self.opened.pop(host, None) is not None:
+                    print(f"Circuit closed for {host}")
+                return
+            self.failures[host] += 1
+            if trial or (host not in self.opened and self.failures[host] >= self.threshold):
+                self.opened[host] = time.monotonic()
+                self.trips[host] += 1
+                print(f"Circuit open for {host} after {self.failures[host]} failures, trying again in {self.cooldown}s")
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to burst requests."""
+
+    def __init__(self, rate, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returning how many seconds to wait before using it.
+
+        The balance may go negative, so concurrent callers are given successive slots rather than racing for one.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+class HostRateLimiter:
+    """A token bucket per host, using the rate and burst of the most specific matching domain in overrides."""
+
+    def __init__(self, rate=None, burst=DEFAULT_BURST, overrides=None):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def limits(self, host):
+        domains = [domain for domain in self.overrides if host == domain or host.endswith(f".{domain}")]
+        if not domains:
+            return self.rate, self.burst
+        limits = self.overrides[max(domains, key=len)]
+        return limits.get("rate", self.rate), limits.get("burst", self.burst)
+
+    def delay(self, url):
+        """Reserves a request to the URL's host, returning the seconds to wait before sending it."""
+        try:
+            host = urlparse(url).hostname or ""
+        except ValueError:
+            host = ""
+        with self.lock:
+            if host not in self.buckets:
+                rate, burst = self.limits(host)
+                self.buckets[host] = TokenBucket(rate, burst) if rate else None
+            bucket = self.buckets[host]
+        return bucket.reserve() if bucket else 0.0
+
+def url_host(url):
+    """Returns the host and port of a URL, or "" when the URL is malformed."""
+    try:
+        return urlparse(url).netloc
+    except ValueError:
+        return ""
+
+def interleave_hosts(urls):
+    """Orders (index, url) pairs round-robin across hosts, so no host's URLs are requested back to back."""
+    by_host = defaultdict(list)
+    for index, url in enumerate(urls):
+        by_host[url_host(url)].append((index, url))
+    return [pair for batch in itertools.zip_longest(*by_host.values()) for pair in batch if pair is not None]
+
+def content_digest(content):
+    """Hashes a page body together with EXTRACTION_VERSION."""
+    return hashlib.sha256(f"{EXTRACTION_VERSION}:".encode() + content).hexdigest()
+
+class StageTimings:
+    """Thread-safe latency histograms for each stage of a run, overall and per host.
+
+    Durations are counted in logarithmic buckets, so memory stays constant however many URLs are timed
+    and percentiles are accurate to within one bucket (10%).
+    """
+
+    def __init__(self, parent=None):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Counter)
+        self.totals = Counter()
+        self.parent = parent
+
+    def record(self, stage, host, seconds):
+        """Records a duration, also passing it on without its host to the parent timings, if any."""
+        bucket = math.ceil(math.log(max(seconds, TIMING_MIN_SECONDS) / TIMING_MIN_SECONDS, TIMING_BUCKET_GROWTH))
+        with self.lock:
+            for key in {(stage, None), (stage, host)}:
+                self.histograms[key][bucket] += 1
+                self.totals[key] += seconds
+        if self.parent is not None:
+            self.parent.record(stage, None, seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage, url):
+        """Times the body of a with block as a stage of the URL's host."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, url_host(url), time.perf_counter() - start)
+
+    def summary(self, host=None):
+        """Returns count, total and percentile seconds for every stage, overall or for one host."""
+        with self.lock:
+            histograms = {stage: Counter(buckets) for (stage, key), buckets in self.histograms.items() if key == host}
+            totals = dict(self.totals)
+        summary = {}
+        for stage, buckets in histograms.items():
+            count = sum(buckets.values())
+            stats = {"count": count, "total": totals[(stage, host)]}
+            for percentile in TIMING_PERCENTILES:
+                seen = 0
+                for bucket in sorted(buckets):
+                    seen += buckets[bucket]
+                    if seen >= count * percentile / 100:
+                        stats[f"p{percentile}"] = TIMING_MIN_SECONDS * TIMING_BUCKET_GROWTH ** bucket
+                        break
+            summary[stage] = stats
+        return summary
+
+    def cumulative(self, stage, bounds):
+        """Returns (count, total, counts at or below each bound) for a stage, as in a Prometheus histogram.
+
+        A bucket is counted under the first bound its upper edge does not exceed, so counts are accurate to within 10%.
+        """
+        with self.lock:
+            buckets = Counter(self.histograms[(stage, None)])
+            total = self.totals[(stage, None)]
+        counts = [sum(count for bucket, count in buckets.items()
+                      if TIMING_MIN_SECONDS * TIMING_BUCKET_GROWTH ** bucket <= bound * (1 + 1e-9)) for bound in bounds]
+        return sum(buckets.values()), total, counts
+
+    def stages(self):
+        with self.lock:
+            return [stage for stage, host in self.histograms if host is None]
+
+    def hosts(self):
+        """Returns the timed hosts, slowest first by total time across stages."""
+        with self.lock:
+            totals = Counter()
+            for (stage, host), seconds in self.totals.items():
+                if host is not None:
+                    totals[host] += seconds
+        return [host for host, _ in totals.most_common()]
+
+    def report(self):
+        """Prints the percentiles of every stage, then of the slowest hosts."""
+        def print_table(summary, indent=""):
+            for stage, stats in summary.items():
+                percentiles = "  ".join(f"p{p} {stats[f'p{p}'] * 1000:>8.1f}ms" for p in TIMING_PERCENTILES)
+                print(f"{indent}{stage:<14} {stats['count']:>6}x  {percentiles}  total {stats['total']:.2f}s")
+
+        print("Stage timings:")
+        print_table(self.summary(), "  ")
+        for host in self.hosts()[:TIMING_REPORT_HOSTS]:
+            print(f"  {host}:")
+            print_table(self.summary(host), "    ")
+
+    def to_json(self):
+        return {"stages": self.summary(), "hosts": {host: self.summary(host) for host in self.hosts()}}
+
+class Metrics:
+    """Counters and stage latency histograms for the whole process, served in the Prometheus text format."""
+
+    COUNTERS = {
+        "fetched": "URLs whose page was downloaded or revalidated",
+        "failed": "URLs that could not be fetched",
+        "bytes": "Response body bytes downloaded",
+        "cache_hits": "Pages served from the response cache after a 304",
+        "retries": "Fetches re-queued after a transient failure",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timings = StageTimings()
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def render(self):
+        """Returns every counter and histogram in the Prometheus text exposition format."""
+        with self.lock:
+            counters = Counter(self.counters)
+        lines = []
+        for name, description in self.COUNTERS.items():
+            metric = f"meta_scraper_{name}_total"
+            lines += [f"# HELP {metric} {description}.", f"# TYPE {metric} counter", f"{metric} {counters[name]}"]
+        metric = "meta_scraper_stage_seconds"
+        lines += [f"# HELP {metric} Time spent in each stage of fetching and processing a URL.",
+                  f"# TYPE {metric} histogram"]
+        for stage in self.timings.stages():
+            count, total, counts = self.timings.cumulative(stage, METRICS_BUCKETS)
+            lines += [f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {n}' for bound, n in zip(METRICS_BUCKETS, counts)]
+            lines += [f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {count}',
+                      f'{metric}_sum{{stage="{stage}"}} {total}', f'{metric}_count{{stage="{stage}"}} {count}']
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the process metrics at /metrics."""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """Serves /metrics from a background thread for as long as the process runs."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics at http://{host}:{server.server_port}/metrics")
+    return server
+
+class CrawlState:
+    """Runtime state shared by the stages of one process_urls run."""
+
+    def __init__(self, options=None, listeners=()):
+        self.options = options or ScrapeOptions()
+        self.connection_stats = Counter()
+        self.timings = StageTimings(metrics.timings)
+        # A replay exists to re-extract pages, so it never reuses cached extractions
+        self.cache = (ResponseCache(self.options.cache_file)
+                      if self.options.cache_file and not self.options.replay else None)
+        self.unchanged = set()
+        # (digest, .md file saved by an earlier run) for fetched URLs whose results are not yet saved
+        self.extractions = {}
+        self.listeners = list(listeners)
+        self.warc = WarcWriter(self.options.warc) if self.options.warc else None
+        self.replay = WarcArchive(self.options.replay) if self.options.replay else None
+        self.dns = DnsCache(self.options.dns_ttl) if self.options.dns_ttl else None
+        self.latency_history = LatencyHistory(self.options.latency_file) if self.options.latency_file else None
+        if self.options.adaptive_timeouts and self.latency_history and self.latency_history.hosts:
+            print(f"Adapting timeouts to the latencies of {len(self.latency_history.hosts)} hosts")
+        self.retries = Counter()
+        self.circuit_waits = Counter()
+        self.breakers = (CircuitBreakers(self.options.breaker_threshold, self.options.breaker_cooldown)
+                         if self.options.breaker_threshold else None)
+        self.lock = threading.Lock()
+        self.rate_limiter = (HostRateLimiter(self.options.rate, self.options.burst, self.options.rate_limits)
+                             if self.options.rate or self.options.rate_limits else None)
+
+    def completed(self, metadata):
+        """Hands a result to the listeners as soon as its URL completes, before results are put in input order."""
+        for listener in self.listeners:
+            with self.timings.timed(listener.stage, metadata["url"]):
+                listener.write(metadata)
+
+    def fetch_order(self, urls):
+        """Returns the (index, url) pairs in the order to fetch them.
+
+        When rate limited, each FETCH_WINDOW of URLs is taken round-robin across hosts, so the order never runs
+        ahead of the fetch window.
+        """
+        if self.rate_limiter is None:
+            return list(enumerate(urls))
+        return [(start + index, url) for start in range(0, len(urls), FETCH_WINDOW)
+                for index, url in interleave_hosts(urls[start:start + FETCH_WINDOW])]
+
+    def rate_limit_delay(self, url):
+        """Reserves a request under the URL's host rate limit, returning the seconds to wait before sending it.
+
+        Replayed responses are read from a local file, so they are never rate limited.
+        """
+        if self.rate_limiter is None or self.replay is not None:
+            return 0.0
+        delay = self.rate_limiter.delay(url)
+        if delay:
+            self.timings.record("rate_limit", url_host(url), delay)
+        return delay
+
+    def retry_delay(self, url, attempt, error):
+        """Counts a retry for the URL's host, returning how long to wait before it.
+
+        The wait doubles with every attempt, randomized between half and all of it, and is never shorter than
+        the server's Retry-After. A URL held back by an open circuit was never sent, so it waits for the circuit
+        to half-open without counting as a retry; the engines do not advance its attempt either.
+        """
+        if isinstance(error, CircuitOpenError):
+            return error.retry_after
+        host = url_host(url)
+        backoff = min(RETRY_MAX_DELAY, self.options.retry_backoff * 2 ** attempt)
+        delay = max(random.uniform(backoff / 2, backoff), error.retry_after or 0)
+        with self.lock:
+            self.retries[host] += 1
+        metrics.increment("retries")
+        self.timings.record("retry_wait", host, delay)
+        print(f"Retrying {url} in {delay:.1f}s: {error}")
+        return delay
+
+    def timeouts(self, url):
+        """Returns the (connect, read, total) timeouts for the URL's host."""
+        options = self.options
+        defaults = options.connect_timeout, options.read_timeout, options.total_timeout
+        if options.adaptive_timeouts and self.latency_history:
+            return self.latency_history.timeouts(url_host(url), *defaults)
+        return defaults
+
+    def circuit_allows(self, url):
+        """Returns True when the URL's host circuit lets a request through.
+
+        Otherwise the URL fails fast: it raises CircuitOpenError to come back once the circuit half-opens, separately
+        from its retries, and after BREAKER_MAX_WAITS of those it is reported failed and False is returned.
+        """
+        host = url_host(url)
+        wait = self.breakers.wait(host) if self.breakers else None
+        if wait is None:
+            return True
+        with self.lock:
+            self.circuit_waits[url] += 1
+            waits = self.circuit_waits[url]
+        if waits <= BREAKER_MAX_WAITS:
+            raise CircuitOpenError(f"circuit open for {host}", wait)
+        print(f"Error fetching metadata for {url}: circuit open for {host}")
+        metrics.increment("failed")
+        return False
+
+    def fetch_succeeded(self, url):
+        if self.breakers:
+            self.breakers.record(url_host(url), failed=False)
+
+    def fetch_failed(self, url, error, transient, can_retry, retry_after=None):
+        """Handles a failed request: a transient failure counts against the host's circuit and raises RetryableError
+        when can_retry; otherwise the failure is reported and None returned. Other errors, such as a 404, show the
+        host is up.
+
+        A server asking for more than RETRY_MAX_DELAY seconds in its Retry-After is not retried before then,
+        so the URL fails instead.
+        """
+        if self.breakers:
+            self.breakers.record(url_host(url), failed=transient)
+        message = str(error) or type(error).__name__
+        if retry_after is not None and retry_after > RETRY_MAX_DELAY:
+            message = f"{message} (Retry-After of {retry_after:g}s is too long to wait)"
+        elif can_retry and transient:
+            raise RetryableError(message, retry_after)
+        print(f"Error fetching metadata for {url}: {message}")
+        metrics.increment("failed")
+        return None
+
+    def archive(self, url, page):
+        """Writes a fetched page to the WARC file, when capturing."""
+        if self.warc is not None:
+            self.warc.write(url, *page)
+
+    def previous_extraction(self, url, digest):
+        """Returns the metadata already extracted from an identical body, or None.
+
+        The digest is kept until the URL's .md file is saved, and record_extraction stores the metadata under it.
+        """
+        if self.cache is None:
+            return None
+        metadata, saved_to = self.cache.extracted(url, digest, self.options.head_only) or (None, None)
+        with self.lock:
+            self.extractions[url] = digest, saved_to
+        return metadata
+
+    def saved_copy(self, url, folder):
+        """Returns the .md file an earlier run saved to the folder for an unchanged body, marking the URL unchanged,
+        or None when the page has to be saved.
+        """
+        with self.lock:
+            digest, saved_to = self.extractions.get(url, (None, None))
+            if (saved_to is None or os.path.dirname(saved_to) != os.path.abspath(folder)
+                    or not os.path.exists(saved_to)):
+                return None
+            del self.extractions[url]
+        self.unchanged.add(url)
+        return saved_to
+
+    def record_timings(self, url, stage_seconds):
+        """Records the seconds spent in each stage for a URL, as returned by timed_extract_metadata."""
+        for stage, seconds in stage_seconds.items():
+            self.timings.record(stage, url_host(url), seconds)
+
+    def record_extraction(self, url, metadata, saved_to):
+        """Stores the metadata extracted for a URL once it is saved, so later runs can skip an identical body."""
+        with self.lock:
+            digest, _ = self.extractions.pop(url, (None, None))
+        if self.cache is not None and digest is not None and saved_to is not None:
+            self.cache.store_extracted(url, digest, self.options.head_only, metadata, os.path.abspath(saved_to))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.latency_history is not None:
+            self.latency_history.update(self.timings)
+            self.latency_history.save()
+        for resource in (self.cache, self.warc, self.replay):
+            if resource is not None:
+                resource.close()
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that tallies whether each request opened a new connection or reused a kept-alive one.
+
+    New connections are timed too: "dns" covers the lookup, "connect" the TCP handshake and "tls" the TLS
+    handshake. With a DNS cache, hosts are looked up there and each cached address is tried in turn.
+    """
+
+    def __init__(self, connection_stats, timings=None, dns=None, **kwargs):
+        self.connection_stats = connection_stats
+        self.timings = timings or StageTimings()
+        self.dns = dns
+        self.stats_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self.counting_pool(pool_cls) for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
         }
 
-        # Open Graph Tags
-        metadata["og_title"] = (soup.find("meta", attrs={"property": "og:title"}) or {}).get("content", no_data).strip()
-        metadata["og_description"] = (soup.find("meta", attrs={"property": "og:description"}) or {}).get("content", no_data).strip()
-        metadata["og_image"] = (soup.find("meta", attrs={"property": "og:image"}) or {}).get("content", no_data).strip()
-        metadata["canonical"] = (soup.find("link", attrs={"rel": "canonical"}) or {}).get("href", no_data).strip()
-
-        # Text Analysis
-        visible_text = " ".join([text for text in soup.stripped_strings])
-        words = re.findall(r'\w+', visible_text.lower())
-        word_counts = Counter(words)
-
-        # Expanded stopwords list including common prepositions and pronouns
-        stopwords = set([
-            "и", "в", "на", "с", "по", "о", "из", "за", "для", "к", "от", "при",
-            "что", "это", "как", "так", "но", "а", "же", "то", "у", "об", "над",
-            "ли", "же", "без", "до", "под", "через", "между", "про", "вне", "поэтому",
-            "мы", "я", "они", "вы", "он", "она", "его", "ее", "их", "мне", "тебе", "вас", "нас"
-        ])
+    def counting_pool(self, pool_cls):
+        connection_stats, stats_lock = self.connection_stats, self.stats_lock
 
-        # Filter out stopwords, one-letter words, and numbers
-        filtered_words = [
-            word for word in words
-            if word not in stopwords and len(word) > 1 and not word.isdigit()
-        ]
-        filtered_word_counts = Counter(filtered_words)
-        metadata["top_words"] = dict(filtered_word_counts.most_common(20))
+        def _make_request(pool, conn, *args, **kwargs):
+            with stats_lock:
+                connection_stats["new" if conn.sock is None else "reused"] += 1
+            return pool_cls._make_request(pool, conn, *args, **kwargs)
 
-        # Images
-        metadata["images"] = [img["src"] for img in soup.find_all("img", src=True)]
+        return type(pool_cls.__name__, (pool_cls,), {
+            "_make_request": _make_request, "ConnectionCls": self.timed_connection(pool_cls.ConnectionCls, pool_cls.scheme),
+        })
 
-        # Links
-        links = [a["href"] for a in soup.find_all("a", href=True)]
-        parsed_url = urlparse(url)
-        metadata["internal_links"] = [link for link in links if parsed_url.netloc in link or link.startswith("/")]
-        metadata["external_links"] = [link for link in links if parsed_url.netloc not in link and not link.startswith("/")]
+    def timed_connection(self, conn_cls, scheme):
+        timings, dns = self.timings, self.dns
 
-        return {k: unicodedata.normalize("NFKC", v) if isinstance(v, str) else v for k, v in metadata.items()}
-    except requests.RequestException as e:
-        print(f"Error fetching metadata for {url}: {e}")
+        def netloc(conn):
+            return conn.host if conn.port in (None, conn.default_port) else f"{conn.host}:{conn.port}"
+
+        def resolve(conn):
+            start = time.perf_counter()
+            try:
+                addresses = dns.resolve(conn._dns_host, conn.port)
+            except OSError:
+                # Let urllib3 resolve the host itself and report the error as usual
+                return []
+            finally:
+                conn.dns_seconds = time.perf_counter() - start
+                timings.record("dns", netloc(conn), conn.dns_seconds)
+            return list(dict.fromkeys(sockaddr[0] for *_, sockaddr in addresses))
+
+        def connect_to(conn, addresses):
+            if not addresses:
+                return conn_cls._new_conn(conn)
+            host = conn._dns_host
+            try:
+                for address in addresses:
+                    conn._dns_host = address
+                    try:
+                        return conn_cls._new_conn(conn)
+                    except (NewConnectionError, ConnectTimeoutError):
+                        if address == addresses[-1]:
+                            raise
+            finally:
+                conn._dns_host = host
+
+        def _new_conn(conn):
+            conn.dns_seconds = 0.0
+            addresses = resolve(conn) if dns else []
+            start = time.perf_counter()
+            try:
+                return connect_to(conn, addresses)
+            finally:
+                conn.connect_seconds = time.perf_counter() - start
+                timings.record("connect", netloc(conn), conn.connect_seconds)
+
+        def connect(conn):
+            start = time.perf_counter()
+            conn_cls.connect(conn)
+            if scheme == "https":
+                timings.record("tls", netloc(conn), time.perf_counter() - start - conn.dns_seconds - conn.connect_seconds)
+
+        return type(conn_cls.__name__, (conn_cls,), {"_new_conn": _new_conn, "connect": connect})
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, connection_stats=None, timings=None, dns=None):
+    """Creates a requests session that keeps up to pool_size connections alive per host."""
+    session = requests.Session()
+    adapter = PooledAdapter(Counter() if connection_stats is None else connection_stats, timings, dns,
+                            pool_connections=POOLED_HOSTS, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def cached_resolver(dns):
+    """Creates an aiohttp resolver that answers from the DNS cache."""
+    class CachedResolver(aiohttp.abc.AbstractResolver):
+        async def resolve(self, host, port=0, family=socket.AF_UNSPEC):
+            addresses = dns.lookup(host, port)
+            if addresses is None:
+                addresses = await asyncio.get_running_loop().run_in_executor(None, dns.resolve, host, port)
+            return [
+                {"hostname": host, "host": sockaddr[0], "port": sockaddr[1], "family": address_family, "proto": proto,
+                 "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV}
+                for address_family, _, proto, _, sockaddr in addresses
+                if family in (socket.AF_UNSPEC, address_family)
+            ]
+
+        async def close(self):
+            pass
+
+    return CachedResolver()
+
+def connection_trace(connection_stats, timings=None):
+    """Creates an aiohttp trace config that tallies new and reused connections.
+
+    New connections are timed too: "dns" covers the lookup, "connect" the TCP and TLS handshakes.
+    """
+    timings = timings or StageTimings()
+
+    async def on_request_start(session, context, params):
+        context.host = params.url.host if params.url.is_default_port() else f"{params.url.host}:{params.url.port}"
+        context.dns_seconds = 0.0
+
+    async def on_dns_start(session, context, params):
+        context.dns_start = time.perf_counter()
+
+    async def on_dns_end(session, context, params):
+        context.dns_seconds = time.perf_counter() - context.dns_start
+        timings.record("dns", context.host, context.dns_seconds)
+
+    async def on_create_start(session, context, params):
+        context.connect_start = time.perf_counter()
+
+    async def on_create(session, context, params):
+        connection_stats["new"] += 1
+        timings.record("connect", context.host, time.perf_counter() - context.connect_start - context.dns_seconds)
+
+    async def on_reuse(session, context, params):
+        connection_stats["reused"] += 1
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_dns_resolvehost_start.append(on_dns_start)
+    trace.on_dns_resolvehost_end.append(on_dns_end)
+    trace.on_connection_create_start.append(on_create_start)
+    trace.on_connection_create_end.append(on_create)
+    trace.on_connection_reuseconn.append(on_reuse)
+    return trace
+
+def iter_body(response, start, read_timeout, total_timeout):
+    """Yields the decoded body of a streamed response as it arrives, raising requests.Timeout once total_timeout
+    seconds have passed since start.
+
+    requests only bounds each socket read, so a server trickling bytes could keep iter_content going for ever.
+    Here every read returns whatever has arrived, waiting no longer than the time left before the deadline.
+    """
+    raw = response.raw
+    sock = raw.connection.sock if raw.connection is not None else None
+    deadline = start + total_timeout
+    try:
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise requests.Timeout(f"Read timed out after the total timeout of {total_timeout:g}s")
+            # urllib3 sets the socket timeout again before a pooled connection's next request
+            if sock is not None:
+                sock.settimeout(min(read_timeout, remaining))
+            chunk = raw.read1(CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    # The translations iter_content makes, so callers only see requests exceptions
+    except ReadTimeoutError as e:
+        if time.perf_counter() >= deadline:
+            raise requests.Timeout(f"Read timed out after the total timeout of {total_timeout:g}s")
+        raise requests.exceptions.ReadTimeout(e)
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+
+def fetch_page(url, session=None, state=None, can_retry=False):
+    """Downloads a page in chunks, returning at most max_bytes of its body and the response headers.
+
+    Cached pages are requested conditionally, and a 304 response is answered from the cache. With can_retry,
+    connection errors, timeouts and RETRY_STATUSES raise RetryableError instead of returning None. While the host's
+    circuit is open, CircuitOpenError is raised whatever can_retry is.
+    """
+    state = state or CrawlState()
+    if state.replay is not None:
+        return state.replay.read(url)
+    if not state.circuit_allows(url):
         return None
+    options, cache = state.options, state.cache
+    reader = BodyReader(options.max_bytes, options.head_only)
+    validators = cache.validators(url) if cache else {}
+    host = url_host(url)
+    connect_timeout, read_timeout, total_timeout = state.timeouts(url)
+    try:
+        start = time.perf_counter()
+        # Closing a partly read response drops its connection instead of downloading the rest
+        with (session or requests).get(url, headers=validators, timeout=(connect_timeout, read_timeout),
+                                       stream=True) as response:
+            headers_received = time.perf_counter()
+            state.timings.record("response", host, headers_received - start)
+            response.raise_for_status()
+            for chunk in iter_body(response, start, read_timeout, total_timeout):
+                if reader.feed(chunk):
+                    break
+        state.timings.record("download", host, time.perf_counter() - headers_received)
+    except requests.RequestException as e:
+        if isinstance(e, requests.Timeout):
+            state.timings.record("timeout", host, time.perf_counter() - start)
+        status = e.response.status_code if e.response is not None else None
+        transient = (isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+                     or status in RETRY_STATUSES)
+        retry_after = parse_retry_after(e.response.headers.get("Retry-After")) if status else None
+        return state.fetch_failed(url, e, transient, can_retry, retry_after)
+    state.fetch_succeeded(url)
+    metrics.increment("fetched")
+    metrics.increment("bytes", len(reader.body))
+    if response.status_code == 304 and validators:
+        metrics.increment("cache_hits")
+        return cache.revalidated(url, response.headers)
+    if reader.truncated and not options.head_only:
+        print(f"Truncated {url} to its first {reader.limit} bytes")
+    if cache and reader.complete:
+        cache.store(url, bytes(reader.body), response.headers)
+    return bytes(reader.body), response.headers
+
+def parse_page(url, content, parse_pool=None, state=None):
+    """Runs extract_metadata inline, or in the process pool when one is given, recording its stage timings."""
+    state = state or CrawlState()
+    options = state.options
+    if parse_pool is None:
+        metadata, stage_seconds = timed_extract_metadata(url, content, options.backend, options.head_only)
+    else:
+        metadata, stage_seconds = parse_pool.submit(
+            timed_extract_metadata, url, content, options.backend, options.head_only
+        ).result()
+    state.record_timings(url, stage_seconds)
+    return metadata
+
+def fetch_metadata(url, session=None, parse_pool=None, state=None, can_retry=False):
+    """Fetches metadata and performs additional analysis."""
+    state = state or CrawlState()
+    with state.timings.timed("fetch_metadata", url):
+        page = fetch_page(url, session, state, can_retry)
+        if page is None:
+            return None
+        state.archive(url, page)
+        content, headers = page
+        digest = content_digest(content)
+        metadata = state.previous_extraction(url, digest)
+        if metadata is None:
+            metadata = parse_page(url, content, parse_pool, state)
+    state.completed(metadata)
+    return metadata
+
+def decode_html(content):
+    """Decodes a page body the same way BeautifulSoup does, so every backend sees the same text."""
+    return UnicodeDammit(content, is_html=True).unicode_markup or ""
+
+def add_string(strings, text):
+    """Appends text to strings the way soup.stripped_strings yields it."""
+    text = text.strip()
+    if text:
+        strings.append(text)
+
+def parse_with_soup(content):
+    """Parses a page with BeautifulSoup and the standard library html.parser."""
+    soup = BeautifulSoup(content, "html.parser")
+    tags = [
+        (element.name, {key: " ".join(value) if isinstance(value, list) else value for key, value in element.attrs.items()})
+        for element in soup.find_all(COLLECTED_TAGS)
+    ]
+    return PageTree(soup.title.get_text() if soup.title else None, tags, list(soup.stripped_strings))
+
+def parse_with_lxml(content):
+    """Parses a page with lxml, walking the tree once for tags and visible text."""
+    markup = decode_html(content)
+    if not markup.strip():
+        return PageTree(None, [], [])
+    root = lxml.html.document_fromstring(markup.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+    title, tags, strings = None, [], []
+    # Tails are pushed before children so they are emitted after the element's subtree
+    stack = [(root, False)]
+    while stack:
+        node, hidden = stack.pop()
+        if isinstance(node, str):
+            add_string(strings, node)
+            continue
+        if node.tail and not hidden:
+            stack.append((node.tail, hidden))
+        if not isinstance(node.tag, str):  # Comments and processing instructions
+            continue
+        if node.tag in COLLECTED_TAGS:
+            tags.append((node.tag, dict(node.attrib)))
+        elif node.tag == "title" and title is None:
+            title = node.text_content()
+        hidden = hidden or node.tag in TEXTLESS_TAGS
+        if node.text and not hidden:
+            add_string(strings, node.text)
+        stack.extend((child, hidden) for child in reversed(node))
+    return PageTree(title, tags, strings)
+
+def parse_with_selectolax(content):
+    """Parses a page with selectolax's lexbor engine, walking the tree once for tags and visible text."""
+    tree = LexborHTMLParser(decode_html(content))
+    title, tags, strings = None, [], []
+    if tree.root is None:
+        return PageTree(title, tags, strings)
+    # Lexbor keeps <template> contents out of the main tree, so only script and style text needs skipping
+    for node in tree.root.traverse(include_text=True):
+        if node.tag == "-text":
+            if node.parent.tag not in TEXTLESS_TAGS:
+                add_string(strings, node.text_content)
+        elif node.tag in COLLECTED_TAGS:
+            tags.append((node.tag, {key: value or "" for key, value in node.attributes.items()}))
+        elif node.tag == "title" and title is None:
+            title = node.text()
+    return PageTree(title, tags, strings)
+
+# lxml and selectolax follow HTML5 where html.parser does not, which the README lists as the cases where results differ
+PARSER_BACKENDS = {
+    "html.parser": parse_with_soup,
+    "lxml": parse_with_lxml,
+    "selectolax": parse_with_selectolax,
+}
+
+def available_parsers():
+    """Lists the parser backends whose libraries are installed."""
+    installed = {"html.parser": BeautifulSoup, "lxml": lxml, "selectolax": LexborHTMLParser}
+    return [name for name in PARSER_BACKENDS if installed[name] is not None]
+
+def extract_metadata(url, content, backend=DEFAULT_PARSER, head_only=False):
+    """Extracts metadata and performs additional analysis on a downloaded page.
+
+    With head_only, only head metadata is extracted and the text, image and link fields are left empty.
+    """
+    return analyze_page(url, PARSER_BACKENDS[backend](content), head_only)
+
+def timed_extract_metadata(url, content, backend=DEFAULT_PARSER, head_only=False):
+    """Runs extract_metadata, also returning the seconds spent parsing the HTML and analyzing the parsed page."""
+    start = time.perf_counter()
+    page = PARSER_BACKENDS[backend](content)
+    parsed = time.perf_counter()
+    metadata = analyze_page(url, page, head_only)
+    return metadata, {"parse": parsed - start, "analysis": time.perf_counter() - parsed}
+
+def analyze_page(url, page, head_only=False):
+    """Builds the metadata of a page from the PageTree produced by a parser backend."""
+    no_data = "— — —"
+
+    # One pass over the collected tags: the first meta/link for every name, property and rel value, plus images and links
+    head, social_tags, images, links = {}, {}, [], []
+    for name, attrs in page.tags:
+        if name == "meta":
+            for key in ("name", "property"):
+                if key in attrs:
+                    head.setdefault((key, attrs[key]), attrs)
+                    if attrs[key].startswith(SOCIAL_PREFIXES):
+                        social_tags.setdefault(attrs[key], unicodedata.normalize("NFKC", attrs.get("content", "").strip()))
+        elif name == "link":
+            for rel in attrs.get("rel", "").split():
+                head.setdefault(("rel", rel), attrs)
+        elif name == "img":
+            if "src" in attrs:
+                images.append(attrs["src"])
+        elif "href" in attrs:
+            links.append(attrs["href"])
+
+    def lookup(key, value, attr="content"):
+        return head.get((key, value), {}).get(attr, no_data).strip()
+
+    # Metadata
+    metadata = {
+        "url": url,
+        "title": (page.title.strip() if page.title is not None else no_data),
+        "description": lookup("name", "description"),
+        "keywords": lookup("name", "keywords"),
+        "author": lookup("name", "author"),
+    }
+
+    # Open Graph Tags
+    metadata["og_title"] = lookup("property", "og:title")
+    metadata["og_description"] = lookup("property", "og:description")
+    metadata["og_image"] = lookup("property", "og:image")
+    metadata["canonical"] = lookup("rel", "canonical", "href")
+
+    # Every og:*, twitter:* and article:* tag, keyed by its name or property
+    metadata["social_tags"] = social_tags
+
+    if head_only:
+        metadata.update(top_words={}, images=[], internal_links=[], external_links=[])
+        return normalize_metadata(metadata)
+
+    # Text Analysis
+    visible_text = " ".join(page.strings)
+    words = re.findall(r'\w+', visible_text.lower())
+    word_counts = Counter(words)
+
+    # Expanded stopwords list including common prepositions and pronouns
+    stopwords = set([
+        "и", "в", "на", "с", "по", "о", "из", "за", "для", "к", "от", "при",
+        "что", "это", "как", "так", "но", "а", "же", "то", "у", "об", "над",
+        "ли", "же", "без", "до", "под", "через", "между", "про", "вне", "поэтому",
+        "мы", "я", "они", "вы", "он", "она", "его", "ее", "их", "мне", "тебе", "вас", "нас"
+    ])
+
+    # Filter out stopwords, one-letter words, and numbers
+    filtered_words = [
+        word for word in words
+        if word not in stopwords and len(word) > 1 and not word.isdigit()
+    ]
+    filtered_word_counts = Counter(filtered_words)
+    metadata["top_words"] = dict(filtered_word_counts.most_common(20))
+
+    # Images
+    metadata["images"] = images
+
+    # Links
+    parsed_url = urlparse(url)
+    metadata["internal_links"] = [link for link in links if parsed_url.netloc in link or link.startswith("/")]
+    metadata["external_links"] = [link for link in links if parsed_url.netloc not in link and not link.startswith("/")]
+
+    return normalize_metadata(metadata)
+
+def normalize_metadata(metadata):
+    """Applies NFKC normalization to the string fields of a metadata dict."""
+    return {k: unicodedata.normalize("NFKC", v) if isinstance(v, str) else v for k, v in metadata.items()}
 
 def save_metadata(metadata, folder):
-    """Saves metadata to an .md file."""
+    """Saves metadata to an .md file, returning its path, or None when it could not be written."""
     timestamp = datetime.now().strftime("%Y%m%d")
     file_name = os.path.join(folder, f"{timestamp}_{metadata['url'].replace('http://', '').replace('https://', '').replace('/', '_')}.md")
     
     domain = metadata["url"].rstrip("/")
     try:
-        with open(file_name, "w", encoding="utf-8") as md_file:
+        with save_lock, open(file_name, "w", encoding="utf-8") as md_file:
             md_file.write(f"# {metadata['url']}\n\n")
 
             # Title
@@ -138,46 +1468,694 @@ def save_metadata(metadata, folder):
                 md_file.write("\n")
 
         print(f"Saved to [{file_name}]")
+        return file_name
     except Exception as e:
         print(f"Error saving metadata for {metadata['url']}: {e}")
+        return None
+
+class CsvWriter:
+    """Writes one CSV row per completed URL to a partial file, renamed to the timestamped CSV when the run finishes."""
+
+    stage = "save_to_csv"
+
+    def __init__(self, base_csv_file, flush_every=CSV_FLUSH_EVERY):
+        timestamp = datetime.now().strftime("%Y%m%d")
+        self.csv_file = f"{base_csv_file.replace('.csv', '')}_{timestamp}.csv"
+        self.partial_file = f"{self.csv_file}.partial"
+        self.flush_every = flush_every
+        self.rows = 0
+        self.file = open(self.partial_file, mode="w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        # Add column headers
+        self.writer.writerow(["url", "title", "description", "keywords", "author", "og_image", "top_words", "external_links"])
+
+    def write(self, metadata):
+        self.writer.writerow([
+            metadata["url"], metadata["title"], metadata["description"],
+            metadata["keywords"], metadata["author"], metadata["og_image"],
+            json.dumps(metadata["top_words"], ensure_ascii=False),
+            json.dumps(metadata["external_links"], ensure_ascii=False)
+        ])
+        self.rows += 1
+        if self.rows % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self, finished=True):
+        """Closes the file, atomically replacing the previous CSV if the run finished with at least one row."""
+        self.file.close()
+        try:
+            if finished and self.rows:
+                os.replace(self.partial_file, self.csv_file)
+                print(f"Data saved to {self.csv_file}")
+            else:
+                os.remove(self.partial_file)
+        except Exception as e:
+            print(f"Error saving to CSV: {e}")
+
+class ParquetWriter:
+    """Writes metadata to a partial Parquet file in row groups as URLs complete, renamed like the CSV when the run finishes.
+
+    top_words and social_tags are stored as map columns and the link lists as list columns.
+    """
+
+    stage = "save_parquet"
+    STRING_COLUMNS = ["url", "title", "description", "keywords", "author", "og_title", "og_description", "og_image",
+                      "canonical"]
+
+    def __init__(self, base_csv_file, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        timestamp = datetime.now().strftime("%Y%m%d")
+        self.parquet_file = f"{base_csv_file.replace('.csv', '')}_{timestamp}.parquet"
+        self.partial_file = f"{self.parquet_file}.partial"
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.pending = []
+        self.schema = pa.schema(
+            [(column, pa.string()) for column in self.STRING_COLUMNS] + [
+                ("social_tags", pa.map_(pa.string(), pa.string())),
+                ("top_words", pa.map_(pa.string(), pa.int64())),
+                ("images", pa.list_(pa.string())),
+                ("internal_links", pa.list_(pa.string())),
+                ("external_links", pa.list_(pa.string())),
+            ]
+        )
+        self.writer = pq.ParquetWriter(self.partial_file, self.schema)
+
+    def write(self, metadata):
+        self.pending.append(metadata)
+        self.rows += 1
+        if len(self.pending) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows as one row group."""
+        if self.pending:
+            self.writer.write_table(pa.Table.from_pylist(self.pending, schema=self.schema))
+            self.pending = []
+
+    def close(self, finished=True):
+        """Closes the file, atomically replacing the previous Parquet file if the run finished with at least one row."""
+        try:
+            self.flush()
+            self.writer.close()
+            if finished and self.rows:
+                os.replace(self.partial_file, self.parquet_file)
+                print(f"Data saved to {self.parquet_file}")
+            else:
+                os.remove(self.partial_file)
+        except Exception as e:
+            print(f"Error saving to Parquet: {e}")
+
+class JsonlWriter:
+    """Appends each full metadata dict as one JSON line to a file, or to stdout for "-", flushing every line."""
+
+    stage = "save_jsonl"
+
+    def __init__(self, path):
+        self.file = sys.__stdout__ if path == "-" else open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def write(self, metadata):
+        line = json.dumps(metadata, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self, finished=True):
+        if self.file is not sys.__stdout__:
+            self.file.close()
+
+class HistoryStore:
+    """SQLite database keeping one snapshot per page and day, with its links and top words, for queries across runs."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, host TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY, page_id INTEGER NOT NULL REFERENCES pages(id), run_date TEXT NOT NULL,
+            fetched_at TEXT NOT NULL, title TEXT, description TEXT, keywords TEXT, author TEXT, og_title TEXT,
+            og_description TEXT, og_image TEXT, canonical TEXT, social_tags TEXT, images TEXT,
+            UNIQUE (page_id, run_date)
+        );
+        CREATE TABLE IF NOT EXISTS links (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots(id), url TEXT NOT NULL, internal INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS words (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots(id), word TEXT NOT NULL, count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pages_host ON pages (host);
+        CREATE INDEX IF NOT EXISTS snapshots_run_date ON snapshots (run_date);
+        CREATE INDEX IF NOT EXISTS links_snapshot ON links (snapshot_id);
+        CREATE INDEX IF NOT EXISTS links_url ON links (url);
+        CREATE INDEX IF NOT EXISTS words_snapshot ON words (snapshot_id);
+        CREATE INDEX IF NOT EXISTS words_word ON words (word);
+    """
+
+    stage = "save_history"
+
+    def __init__(self, path, commit_every=HISTORY_COMMIT_EVERY):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db_path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        self.run_date = datetime.now().strftime("%Y-%m-%d")
+        self.commit_every = commit_every
+        self.rows = 0
+
+    def write(self, metadata):
+        """Stores today's snapshot of a page, replacing one from an earlier run on the same day."""
+        url = metadata["url"]
+        self.db.execute("INSERT OR IGNORE INTO pages (url, host) VALUES (?, ?)", (url, urlparse(url).netloc))
+        page_id = self.db.execute("SELECT id FROM pages WHERE url = ?", (url,)).fetchone()[0]
+        previous = self.db.execute(
+            "SELECT id FROM snapshots WHERE page_id = ? AND run_date = ?", (page_id, self.run_date)
+        ).fetchone()
+        if previous:
+            for table in ("links", "words"):
+                self.db.execute(f"DELETE FROM {table} WHERE snapshot_id = ?", previous)
+            self.db.execute("DELETE FROM snapshots WHERE id = ?", previous)
+        snapshot_id = self.db.execute(
+            "INSERT INTO snapshots (page_id, run_date, fetched_at, title, description, keywords, author, og_title, "
+            "og_description, og_image, canonical, social_tags, images) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (page_id, self.run_date, datetime.now().isoformat(), metadata["title"], metadata["description"],
+             metadata["keywords"], metadata["author"], metadata["og_title"], metadata["og_description"],
+             metadata["og_image"], metadata["canonical"],
+             json.dumps(metadata.get("social_tags", {}), ensure_ascii=False),
+             json.dumps(metadata["images"], ensure_ascii=False)),
+        ).lastrowid
+        self.db.executemany(
+            "INSERT INTO links VALUES (?, ?, ?)",
+            [(snapshot_id, link, 1) for link in metadata["internal_links"]]
+            + [(snapshot_id, link, 0) for link in metadata["external_links"]],
+        )
+        self.db.executemany(
+            "INSERT INTO words VALUES (?, ?, ?)", [(snapshot_id, word, count) for word, count in metadata["top_words"].items()]
+        )
+        self.rows += 1
+        if self.rows % self.commit_every == 0:
+            self.db.commit()
+
+    def close(self, finished=True):
+        """Commits the snapshots written so far; they are kept even if the run did not finish."""
+        try:
+            self.db.commit()
+            self.db.close()
+            if finished and self.rows:
+                print(f"History saved to {self.db_path}")
+        except Exception as e:
+            print(f"Error saving history: {e}")
 
 def save_to_csv(metadata_list, base_csv_file):
     """Saves metadata list to a CSV file with a timestamp, overwriting the previous file."""
-    timestamp = datetime.now().strftime("%Y%m%d")
-    csv_file = f"{base_csv_file.replace('.csv', '')}_{timestamp}.csv"
-
-    try:
-        with open(csv_file, mode="w", encoding="utf-8", newline="") as file:
-            writer = csv.writer(file)
-            # Add column headers
-            writer.writerow(["url", "title", "description", "keywords", "author", "og_image", "top_words", "external_links"])
-            for metadata in metadata_list:
-                writer.writerow([
-                    metadata["url"], metadata["title"], metadata["description"],
-                    metadata["keywords"], metadata["author"], metadata["og_image"],
-                    json.dumps(metadata["top_words"], ensure_ascii=False),
-                    json.dumps(metadata["external_links"], ensure_ascii=False)
-                ])
-        print(f"Data saved to {csv_file}")
+    try:
+        writer = CsvWriter(base_csv_file)
     except Exception as e:
         print(f"Error saving to CSV: {e}")
+        return
+    for metadata in metadata_list:
+        writer.write(metadata)
+    writer.close()
 
-def process_urls(urls, folder, csv_file):
-    """Processes a list of URLs, saves metadata to the folder and CSV file."""
-    metadata_list = []
-    for site in urls:
-        print(f"Fetching metadata for: {site}")
-        metadata = fetch_metadata(site)
+async def fetch_page_async(session, url, state, can_retry=False):
+    """Async counterpart of fetch_page that does not block the event loop."""
+    if not state.circuit_allows(url):
+        return None
+    options, cache = state.options, state.cache
+    reader = BodyReader(options.max_bytes, options.head_only)
+    validators = cache.validators(url) if cache else {}
+    host = url_host(url)
+    connect_timeout, read_timeout, total_timeout = state.timeouts(url)
+    timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout)
+    try:
+        start = time.perf_counter()
+        async with session.get(url, headers=validators, timeout=timeout) as response:
+            headers_received = time.perf_counter()
+            state.timings.record("response", host, headers_received - start)
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if reader.feed(chunk):
+                    # Close rather than release, so the unread remainder is never downloaded
+                    response.close()
+                    break
+        state.timings.record("download", host, time.perf_counter() - headers_received)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        if isinstance(e, asyncio.TimeoutError):
+            state.timings.record("timeout", host, time.perf_counter() - start)
+        status = e.status if isinstance(e, aiohttp.ClientResponseError) else None
+        transient = (isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+                     or status in RETRY_STATUSES)
+        retry_after = parse_retry_after(e.headers.get("Retry-After")) if status and e.headers else None
+        return state.fetch_failed(url, e, transient, can_retry, retry_after)
+    state.fetch_succeeded(url)
+    metrics.increment("fetched")
+    metrics.increment("bytes", len(reader.body))
+    if response.status == 304 and validators:
+        metrics.increment("cache_hits")
+        return cache.revalidated(url, response.headers)
+    if reader.truncated and not options.head_only:
+        print(f"Truncated {url} to its first {reader.limit} bytes")
+    if cache and reader.complete:
+        cache.store(url, bytes(reader.body), response.headers)
+    return bytes(reader.body), response.headers
+
+async def fetch_metadata_async(session, url, global_limit, host_limits, parse_pool, state):
+    """Fetches a page within the global and per-host limits, then parses it off the event loop.
+
+    Transient failures are retried after a backoff, waited out without holding a slot.
+    """
+    try:
+        host = urlparse(url).netloc
+    except ValueError as e:
+        print(f"Error fetching metadata for {url}: {e}")
+        metrics.increment("failed")
+        return None
+    attempt = 0
+    while True:
+        # Wait out the host's rate limit before taking a slot, so other hosts can use the slot meanwhile
+        await asyncio.sleep(state.rate_limit_delay(url))
+        async with global_limit, host_limits[host]:
+            print(f"Fetching metadata for: {url}")
+            # Timed from here like fetch_metadata, leaving out the wait for a free slot
+            start = time.perf_counter()
+            try:
+                page = await fetch_page_async(session, url, state, attempt < state.options.retries)
+                break
+            except RetryableError as e:
+                delay = state.retry_delay(url, attempt, e)
+                # Only a request that was sent uses up an attempt
+                attempt += not isinstance(e, CircuitOpenError)
+        await asyncio.sleep(delay)
+    try:
+        if page is None:
+            return None
+        state.archive(url, page)
+        content, headers = page
+        digest = content_digest(content)
+        metadata = state.previous_extraction(url, digest)
         if metadata is None:
-            print(f"Skipping {site}: Unable to fetch metadata (URL might be invalid or inaccessible).")
+            metadata, stage_seconds = await asyncio.get_running_loop().run_in_executor(
+                parse_pool, timed_extract_metadata, url, content, state.options.backend, state.options.head_only
+            )
+            state.record_timings(url, stage_seconds)
+    finally:
+        state.timings.record("fetch_metadata", host, time.perf_counter() - start)
+    state.completed(metadata)
+    return metadata
+
+async def fetch_all_async(urls, state, parse_pool, on_result):
+    """Fetches metadata for all URLs concurrently, passing (index, (url, metadata)) to on_result as each completes."""
+    options = state.options
+    global_limit = asyncio.Semaphore(options.concurrency)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(options.per_host))
+    dns_options = dict(resolver=cached_resolver(state.dns), use_dns_cache=False) if state.dns else {}
+    connector = aiohttp.TCPConnector(limit=options.concurrency, limit_per_host=options.pool_size, **dns_options)
+    async with aiohttp.ClientSession(connector=connector,
+                                     trace_configs=[connection_trace(state.connection_stats, state.timings)]) as session:
+        async def fetch(index, url):
+            return index, (url, await fetch_metadata_async(session, url, global_limit, host_limits, parse_pool, state))
+
+        async def finish_next():
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            # Tasks leave running one at a time, so after an error the rest are still awaited below
+            for task in done:
+                running.discard(task)
+                index, result = task.result()
+                window.complete(index)
+                # on_result may block while the consumer catches up, so it runs off the event loop
+                await asyncio.to_thread(on_result, (index, result))
+
+        window, running = FetchWindow(), set()
+        try:
+            for index, url in state.fetch_order(urls):
+                while not window.allows(index):
+                    await finish_next()
+                running.add(asyncio.create_task(fetch(index, url)))
+            while running:
+                await finish_next()
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+class FetchWindow:
+    """Tracks which URL indices are done, letting a fetch start at most size indices past the first unfinished one.
+
+    This bounds the URLs in flight and the results in_input_order holds back, however long the list is.
+    """
+
+    def __init__(self, size=FETCH_WINDOW):
+        self.size = size
+        self.done = set()
+        self.first_unfinished = 0
+
+    def allows(self, index):
+        return index < self.first_unfinished + self.size
+
+    def complete(self, index):
+        self.done.add(index)
+        while self.first_unfinished in self.done:
+            self.done.remove(self.first_unfinished)
+            self.first_unfinished += 1
+
+def in_input_order(indexed_results):
+    """Re-orders (index, result) pairs arriving in any order, yielding each result as soon as its turn comes."""
+    pending, next_index = {}, 0
+    for index, result in indexed_results:
+        pending[index] = result
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+
+def stream_async(urls, state, parse_pool):
+    """Runs the async engine in a background thread, yielding (url, metadata) pairs in input order as they complete.
+
+    Fetching pauses while FETCH_WINDOW results are waiting to be consumed. When the consumer stops early, the
+    fetches are cancelled and the thread has exited by the time the generator closes, so the state it shares can
+    be closed safely.
+    """
+    results = queue.Queue(maxsize=FETCH_WINDOW)
+    loop = asyncio.new_event_loop()
+    fetching = loop.create_task(fetch_all_async(urls, state, parse_pool, results.put))
+
+    def run():
+        try:
+            loop.run_until_complete(fetching)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            results.put(e)
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+        results.put(None)
+
+    def completed():
+        while (item := results.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield from in_input_order(completed())
+    finally:
+        with contextlib.suppress(RuntimeError):  # The loop is already closed
+            loop.call_soon_threadsafe(fetching.cancel)
+        # Keep taking results, so a fetch blocked on the full queue can finish
+        while thread.is_alive():
+            with contextlib.suppress(queue.Empty):
+                results.get(timeout=0.1)
+
+def fetch_with_retries(order, fetch, state, workers):
+    """Runs fetch(url, can_retry) for (index, url) pairs in a thread pool, yielding (index, (url, metadata)) as each completes.
+
+    URLs are handed to workers only as they free up and within the FetchWindow. A URL whose host is rate limited,
+    or that raises RetryableError, is queued to run once its wait is over, rather than sleeping in its worker.
+    """
+    retries = state.options.retries
+    order, window = iter(order), FetchWindow()
+    # (time, index, url, attempt, reserved) for URLs waiting out a rate limit or a retry backoff
+    waiting, running = [], {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(index, url, attempt, reserved=False):
+        delay = 0.0 if reserved else state.rate_limit_delay(url)
+        if delay:
+            heapq.heappush(waiting, (time.monotonic() + delay, index, url, attempt, True))
+        else:
+            running[executor.submit(fetch, url, attempt < retries)] = (index, url, attempt)
+
+    try:
+        upcoming = next(order, None)
+        while running or waiting or upcoming:
+            while waiting and waiting[0][0] <= time.monotonic() and len(running) < workers:
+                submit(*heapq.heappop(waiting)[1:])
+            while upcoming and len(running) < workers and window.allows(upcoming[0]):
+                submit(*upcoming, 0)
+                upcoming = next(order, None)
+            timeout = max(0.0, waiting[0][0] - time.monotonic()) if waiting and len(running) < workers else None
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, url, attempt = running.pop(future)
+                try:
+                    metadata = future.result()
+                except RetryableError as e:
+                    retry_at = time.monotonic() + state.retry_delay(url, attempt, e)
+                    # Only a request that was sent uses up an attempt
+                    attempt += not isinstance(e, CircuitOpenError)
+                    heapq.heappush(waiting, (retry_at, index, url, attempt, False))
+                    continue
+                window.complete(index)
+                yield index, (url, metadata)
+    finally:
+        # Fetches not yet started are dropped when the caller stops early, e.g. on Ctrl-C or a failed write
+        executor.shutdown(cancel_futures=True)
+
+def fetch_all(urls, state=None):
+    """Yields (url, metadata) pairs in input order, each as soon as it and the URLs before it are done.
+
+    Uses a thread pool when options.workers is set, otherwise the async engine when available,
+    falling back to fetching one URL at a time. With options.parse_workers, pages are parsed in
+    a process pool while further downloads continue.
+    """
+    state = state or CrawlState()
+    options = state.options
+    if state.dns and not options.replay:
+        state.dns.prefetch(urls)
+    parse_pool = ProcessPoolExecutor(max_workers=options.parse_workers) if options.parse_workers else None
+    try:
+        # Replayed responses come from a local file, so the network engines are not needed
+        if options.workers or options.replay or aiohttp is None or options.concurrency <= 1:
+            with create_session(options.pool_size, state.connection_stats, state.timings, state.dns) as session:
+                def fetch(site, can_retry):
+                    print(f"Fetching metadata for: {site}")
+                    return fetch_metadata(site, session, parse_pool, state, can_retry)
+
+                yield from in_input_order(fetch_with_retries(state.fetch_order(urls), fetch, state, options.workers or 1))
         else:
-            save_metadata(metadata, folder)
-            metadata_list.append(metadata)
-    if metadata_list:
-        save_to_csv(metadata_list, csv_file)
+            yield from stream_async(urls, state, parse_pool)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+class Journal:
+    """Append-only JSONL record of the URLs a run has completed and their metadata, used to resume it.
+
+    Only the offset of each URL's line is kept in memory; its metadata is read back from the file when needed.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.offsets = {}
+        end = 0
+        if resume and os.path.exists(path):
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        url = json.loads(line)["url"]
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.offsets[url] = end
+                    end += len(line)
+        # Drop a last line cut short by a crash, so new lines are appended after the last complete one
+        self.file = open(path, "r+b" if end else "wb")
+        self.file.truncate(end)
+        self.file.seek(end)
+
+    def __contains__(self, url):
+        return url in self.offsets
+
+    def read(self, url):
+        """Returns the journaled metadata for a URL."""
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[url])
+            return json.loads(f.readline())
+
+    def record(self, metadata):
+        self.offsets[metadata["url"]] = self.file.tell()
+        self.file.write(json.dumps(metadata, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.file.flush()
+
+    def close(self, finished):
+        """Closes the journal, deleting it once the run it records has finished."""
+        self.file.close()
+        if finished:
+            os.remove(self.path)
+
+def journal_path(base_csv_file):
+    """Returns the journal file kept next to the CSV while a run is in progress."""
+    return f"{base_csv_file.replace('.csv', '')}.journal.jsonl"
+
+def save_timings(timings, base_csv_file):
+    """Saves the stage timing percentiles of a run to a timestamped JSON file next to its CSV."""
+    timestamp = datetime.now().strftime("%Y%m%d")
+    timings_file = f"{base_csv_file.replace('.csv', '')}_{timestamp}.timings.json"
+    try:
+        with open(timings_file, "w", encoding="utf-8") as f:
+            json.dump(timings.to_json(), f, indent=2)
+        print(f"Timings saved to {timings_file}")
+    except Exception as e:
+        print(f"Error saving timings: {e}")
+
+def process_urls(urls, folder, csv_file, options=None):
+    """Processes a list of URLs, saves metadata to the folder and CSV file.
+
+    Rows are streamed to the CSV as URLs complete. Every completed URL is also journaled, so with
+    options.resume an interrupted run skips the URLs it already finished.
+    """
+    options = options or ScrapeOptions()
+    journal = Journal(journal_path(csv_file), options.resume)
+    resumed = set(journal.offsets)
+    if resumed:
+        print(f"Resuming: {len(resumed)} URLs already completed")
+    csv_writer = CsvWriter(csv_file)
+    sinks = [csv_writer]
+    if options.parquet:
+        sinks.append(ParquetWriter(csv_file))
+    if options.history_db:
+        sinks.append(HistoryStore(options.history_db))
+    # The JSONL stream gets results in completion order, straight from the fetch stage
+    listeners = [JsonlWriter(options.jsonl)] if options.jsonl else []
+    finished = False
+    try:
+        # The fetches are stopped before the state they share is closed, also when a sink fails
+        with (CrawlState(options, listeners) as state,
+              contextlib.closing(fetch_all([url for url in urls if url not in resumed], state)) as fetched):
+            for url in urls:
+                if url in resumed:
+                    metadata = journal.read(url)
+                else:
+                    site, metadata = next(fetched)
+                    if metadata is None:
+                        print(f"Skipping {site}: Unable to fetch metadata (URL might be invalid or inaccessible).")
+                        continue
+                    # Pages whose body is unchanged since an earlier run into this folder already have their .md file
+                    if state.saved_copy(site, folder) is None:
+                        with state.timings.timed("save_metadata", site):
+                            saved_to = save_metadata(metadata, folder)
+                        state.record_extraction(site, metadata, saved_to)
+                    journal.record(metadata)
+                for sink in sinks:
+                    with state.timings.timed(sink.stage, url):
+                        sink.write(metadata)
+            connection_stats = state.connection_stats
+            cache_hits = state.cache.hits if state.cache else 0
+            print(f"Fetched {csv_writer.rows} of {len(urls)} URLs: {connection_stats['new']} new connections, "
+                  f"{connection_stats['reused']} reused, {cache_hits} served from cache (304), "
+                  f"{len(state.unchanged)} unchanged pages skipped, {sum(state.retries.values())} retries")
+            if state.retries:
+                print("Retries by host: " + ", ".join(f"{host} ({count})" for host, count in state.retries.most_common()))
+            if state.breakers and state.breakers.trips:
+                print("Circuits opened: " + ", ".join(f"{host} ({count})" for host, count in state.breakers.trips.most_common()))
+            state.timings.report()
+            if options.timings_json:
+                save_timings(state.timings, csv_file)
+        finished = True
+    finally:
+        for sink in sinks + listeners:
+            sink.close(finished)
+        journal.close(finished)
+
+def parse_args():
+    """Parses command-line options."""
+    parser = argparse.ArgumentParser(description="Extracts website metadata listed in websites.json.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"maximum requests in flight overall (default: {DEFAULT_CONCURRENCY}, 1 disables the async engine)")
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST,
+                        help=f"maximum requests in flight per host (default: {DEFAULT_PER_HOST})")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE,
+                        help=f"keep-alive connections kept open per host (default: {DEFAULT_POOL_SIZE})")
+    parser.add_argument("--workers", type=int,
+                        help="fetch with a pool of N threads instead of the async engine")
+    parser.add_argument("--parse-workers", type=int,
+                        help="parse pages in a pool of N processes while downloads continue")
+    parser.add_argument("--parser", choices=list(PARSER_BACKENDS), default=DEFAULT_PARSER,
+                        help=f"HTML parser backend (default: {DEFAULT_PARSER})")
+    parser.add_argument("--head-only", action="store_true",
+                        help="stop downloading after </head> and skip text, image and link analysis")
+    parser.add_argument("--max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help=f"stop downloading a page after this many bytes (default: {DEFAULT_MAX_BYTES})")
+    parser.add_argument("--cache-file", default=CACHE_FILE,
+                        help=f"SQLite file caching responses for conditional requests (default: {CACHE_FILE})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always download pages in full without using the response cache")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip URLs an interrupted run already completed, as recorded in its journal")
+    parser.add_argument("--parquet", action="store_true",
+                        help="also write results to a Parquet file next to the CSV (requires pyarrow)")
+    parser.add_argument("--history-db", metavar="PATH",
+                        help="also store a dated snapshot of every page in this SQLite database")
+    parser.add_argument("--jsonl", metavar="PATH",
+                        help="append each result as a JSON line as soon as its URL completes ('-' for stdout)")
+    parser.add_argument("--timings-json", action="store_true",
+                        help="also save the per-stage and per-host timing percentiles as JSON next to the CSV")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help=f"serve Prometheus metrics at http://{METRICS_HOST}:PORT/metrics while running")
+    parser.add_argument("--rate", type=float,
+                        help="maximum requests per second to each host (default: unlimited)")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST,
+                        help=f"requests a host may receive at once before --rate applies (default: {DEFAULT_BURST})")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help=f"times to retry connection errors, timeouts and 429/5xx responses (default: {DEFAULT_RETRIES})")
+    parser.add_argument("--retry-backoff", type=float, default=DEFAULT_RETRY_BACKOFF,
+                        help=f"seconds before the first retry, doubling after each (default: {DEFAULT_RETRY_BACKOFF})")
+    parser.add_argument("--breaker-threshold", type=int, default=DEFAULT_BREAKER_THRESHOLD,
+                        help=f"consecutive failures that make a host fail fast, 0 to disable (default: {DEFAULT_BREAKER_THRESHOLD})")
+    parser.add_argument("--breaker-cooldown", type=float, default=DEFAULT_BREAKER_COOLDOWN,
+                        help=f"seconds a failing host is skipped before it is tried again (default: {DEFAULT_BREAKER_COOLDOWN})")
+    parser.add_argument("--connect-timeout", type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                        help=f"seconds to wait for a connection (default: {DEFAULT_CONNECT_TIMEOUT})")
+    parser.add_argument("--read-timeout", type=float, default=DEFAULT_READ_TIMEOUT,
+                        help=f"seconds to wait for the server to send anything (default: {DEFAULT_READ_TIMEOUT})")
+    parser.add_argument("--total-timeout", type=float, default=DEFAULT_TOTAL_TIMEOUT,
+                        help=f"seconds a whole request may take (default: {DEFAULT_TOTAL_TIMEOUT})")
+    parser.add_argument("--adaptive-timeouts", action="store_true",
+                        help=f"scale each host's timeouts to {ADAPTIVE_TIMEOUT_FACTOR}x its p99 latencies from earlier runs")
+    parser.add_argument("--latency-file", default=LATENCY_FILE,
+                        help=f"JSON file keeping each host's latencies between runs (default: {LATENCY_FILE})")
+    parser.add_argument("--dns-ttl", type=float, default=DNS_CACHE_TTL,
+                        help=f"seconds host lookups are cached for, 0 to disable the cache and prefetch (default: {DNS_CACHE_TTL})")
+    parser.add_argument("--warc", metavar="PATH",
+                        help="append every fetched response to a WARC file (gzipped per record for .warc.gz)")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="read responses from a WARC file instead of the network")
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.burst < 1:
+        parser.error("--burst must be at least 1")
+    if args.replay and not os.path.exists(args.replay):
+        parser.error(f"--replay {args.replay} does not exist")
+    if args.parser not in available_parsers():
+        parser.error(f"--parser {args.parser} requires the {args.parser} package to be installed")
+    if args.parquet and pa is None:
+        parser.error("--parquet requires the pyarrow package to be installed")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
+    options = ScrapeOptions(
+        concurrency=args.concurrency, per_host=args.per_host, pool_size=args.pool_size, workers=args.workers,
+        parse_workers=args.parse_workers, backend=args.parser, head_only=args.head_only,
+        max_bytes=args.max_bytes, cache_file=None if args.no_cache else args.cache_file,
+        resume=args.resume, parquet=args.parquet, history_db=args.history_db,
+        jsonl=args.jsonl, timings_json=args.timings_json, warc=args.warc, replay=args.replay,
+        rate=args.rate, burst=args.burst, rate_limits=load_rate_limits(WEBSITES_FILE),
+        retries=args.retries, retry_backoff=args.retry_backoff,
+        breaker_threshold=args.breaker_threshold, breaker_cooldown=args.breaker_cooldown,
+        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, total_timeout=args.total_timeout,
+        adaptive_timeouts=args.adaptive_timeouts, latency_file=args.latency_file, dns_ttl=args.dns_ttl,
+    )
     websites, partisans_urls = load_websites(WEBSITES_FILE)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
 
     websites_csv = os.path.join(OUTPUT_FOLDER, "websites_metadata.csv")
     partisans_csv = os.path.join(PARTISANS_FOLDER, "partisans_metadata.csv")
@@ -185,7 +2163,9 @@ if __name__ == "__main__":
     if not websites and not partisans_urls:
         print(f"No websites or partisans URLs found in {WEBSITES_FILE}. Please add URLs to the file.")
     else:
-        if websites:
-            process_urls(websites, OUTPUT_FOLDER, websites_csv)
-        if partisans_urls:
-            process_urls(partisans_urls, PARTISANS_FOLDER, partisans_csv)
+        # Keep stdout for the JSONL stream and send progress messages to stderr
+        with contextlib.redirect_stdout(sys.stderr) if args.jsonl == "-" else contextlib.nullcontext():
+            if websites:
+                process_urls(websites, OUTPUT_FOLDER, websites_csv, options)
+            if partisans_urls:
+                process_urls(partisans_urls, PARTISANS_FOLDER, partisans_csv, options)